@@ -6,35 +6,146 @@ Cross-platform support for Windows, macOS, and Linux.
 import json
 import sys
 import os
+import re
 import subprocess
-from datetime import datetime, timezone
-from claude_code_capture_utils import get_log_file_path, add_ab_metadata
+import tempfile
+from claude_code_capture_utils import (
+    get_log_file_path, add_ab_metadata, utc_now_iso, write_log_entry_atomic, get_safe_session_id
+)
+
+# Git metadata is cached across hook invocations, keyed by repo directory.
+# The cache lives in the user's own cache directory rather than the shared
+# temp directory, where another local user could plant it first.
+GIT_METADATA_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "claude_hooks"
+)
+GIT_METADATA_CACHE_FILE = os.path.join(GIT_METADATA_CACHE_DIR, "git_meta_cache.json")
+GIT_METADATA_CACHE_MAX_ENTRIES = 32
+
+# Full SHA-1 or SHA-256 object name
+GIT_COMMIT_SHA_RE = re.compile(r'[0-9a-f]{40}([0-9a-f]{24})?')
+
+def get_git_head_key(repo_dir):
+    """Build a cache key that changes whenever HEAD or the branch it points to moves."""
+    try:
+        git_dir = os.path.join(repo_dir, '.git')
+        head_path = os.path.join(git_dir, 'HEAD')
+        head_mtime = os.stat(head_path).st_mtime_ns
+
+        with open(head_path, 'r', encoding='utf-8') as f:
+            head = f.read().strip()
+
+        # A commit on the current branch rewrites the ref file, not HEAD
+        # itself. A loose ref is keyed on its contents (the commit hash), which
+        # costs the same as a stat and is not fooled by coarse mtimes
+        ref_state = None
+        if head.startswith('ref: '):
+            ref_path = os.path.join(git_dir, *head[len('ref: '):].split('/'))
+            packed_refs_path = os.path.join(git_dir, 'packed-refs')
+            if os.path.isfile(ref_path):
+                with open(ref_path, 'r', encoding='utf-8') as f:
+                    ref_state = f.read().strip()
+            elif os.path.exists(packed_refs_path):
+                ref_state = os.stat(packed_refs_path).st_mtime_ns
+            else:
+                # Unborn branch or a ref backend other than files (reftable
+                # keeps HEAD as a fixed stub): nothing to key on, skip the cache
+                return None
+
+        return f"{head_mtime}:{ref_state}:{head}"
+    except (OSError, ValueError):
+        # Not a repo root (or .git is a worktree file): skip the cache
+        return None
+
+def read_git_metadata_cache():
+    """Read the git metadata cache, returning an empty dict if unavailable."""
+    try:
+        with open(GIT_METADATA_CACHE_FILE, 'r', encoding='utf-8') as f:
+            # Only trust a cache file written by this user
+            if hasattr(os, "getuid") and os.fstat(f.fileno()).st_uid != os.getuid():
+                return {}
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def write_git_metadata_cache(cache):
+    """Atomically replace the git metadata cache file."""
+    try:
+        os.makedirs(GIT_METADATA_CACHE_DIR, mode=0o700, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=GIT_METADATA_CACHE_DIR, prefix=".git_meta_", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(cache, f)
+            os.replace(temp_path, GIT_METADATA_CACHE_FILE)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    except OSError:
+        pass
 
 def get_git_metadata(repo_dir):
-    """Get current git commit and branch."""
+    """Get current git commit and branch, reusing cached values while HEAD is unchanged."""
+    head_key = get_git_head_key(repo_dir) if repo_dir else None
+    cache = read_git_metadata_cache() if head_key else {}
+
+    cached = cache.get(repo_dir)
+    if (isinstance(cached, dict) and cached.get("key") == head_key
+            and isinstance(cached.get("base_commit"), str)
+            and GIT_COMMIT_SHA_RE.fullmatch(cached["base_commit"])):
+        return {
+            "base_commit": cached["base_commit"],
+            "branch": cached.get("branch"),
+            "timestamp": utc_now_iso()
+        }
+
+    git_metadata = query_git_metadata(repo_dir)
+
+    if git_metadata and head_key:
+        # Re-insert at the end so the oldest repos are evicted first
+        cache.pop(repo_dir, None)
+        cache[repo_dir] = {
+            "key": head_key,
+            "base_commit": git_metadata["base_commit"],
+            "branch": git_metadata["branch"]
+        }
+        while len(cache) > GIT_METADATA_CACHE_MAX_ENTRIES:
+            del cache[next(iter(cache))]
+        write_git_metadata_cache(cache)
+
+    return git_metadata
+
+def query_git_metadata(repo_dir):
+    """Query git for the current commit and branch."""
     try:
-        # Get current commit hash
-        commit_result = subprocess.run(
-            ['git', 'rev-parse', 'HEAD'],
+        # Get current commit hash and branch in a single invocation.
+        # --symbolic-full-name only applies to the arguments after it, so
+        # line 0 is the full hash and line 1 the full ref ("HEAD" when
+        # detached). Unlike --abbrev-ref it stays unambiguous when a tag
+        # shares the branch name.
+        rev_parse_result = subprocess.run(
+            ['git', '--no-optional-locks', 'rev-parse', 'HEAD', '--symbolic-full-name', 'HEAD'],
             cwd=repo_dir,
             capture_output=True,
             text=True,
-            timeout=10
+            timeout=3
         )
 
-        # Get current branch
-        branch_result = subprocess.run(
-            ['git', 'branch', '--show-current'],
-            cwd=repo_dir,
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
+        if rev_parse_result.returncode != 0:
+            return None
+
+        lines = rev_parse_result.stdout.strip().splitlines()
+        if len(lines) < 2:
+            return None
+
+        commit, ref = lines[0].strip(), lines[1].strip()
+        branch = ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else None
 
         git_metadata = {
-            "base_commit": commit_result.stdout.strip() if commit_result.returncode == 0 else None,
-            "branch": branch_result.stdout.strip() if branch_result.returncode == 0 else None,
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            "base_commit": commit or None,
+            "branch": branch or None,
+            "timestamp": utc_now_iso()
         }
 
         if git_metadata["base_commit"]:
@@ -59,8 +170,11 @@ def main():
 
         input_data = json.load(sys.stdin)
 
-        session_id = input_data.get("session_id", "unknown")
+        # Log paths are derived from the session ID, so a missing ID gets a
+        # per-transcript fallback instead of sharing session_unknown.jsonl
+        original_session_id = input_data.get("session_id")
         transcript_path = input_data.get("transcript_path", "")
+        session_id = get_safe_session_id(original_session_id, transcript_path)
         cwd = input_data.get("cwd", "")
 
         if event_type == "start":
@@ -69,13 +183,16 @@ def main():
 
             log_entry = {
                 "type": "session_start",
-                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "timestamp": utc_now_iso(),
                 "session_id": session_id,
                 "transcript_path": transcript_path,
                 "cwd": cwd,
                 "git_metadata": git_metadata
             }
 
+            if session_id != original_session_id:
+                log_entry["original_session_id"] = original_session_id
+
             log_entry = add_ab_metadata(log_entry, cwd)
 
             if git_metadata:
@@ -83,26 +200,27 @@ def main():
 
             # Write session_start event
             log_file = get_log_file_path(session_id, cwd)
-            with open(log_file, "a", encoding="utf-8") as f:
-                f.write(json.dumps(log_entry) + "\n")
+            write_log_entry_atomic(log_file, log_entry)
 
         elif event_type == "end":
             # Session end: log the event
             log_entry = {
                 "type": "session_end",
-                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "timestamp": utc_now_iso(),
                 "session_id": session_id,
                 "transcript_path": transcript_path,
                 "cwd": cwd,
                 "reason": input_data.get("reason", "")
             }
 
+            if session_id != original_session_id:
+                log_entry["original_session_id"] = original_session_id
+
             log_entry = add_ab_metadata(log_entry, cwd)
 
             # Write session_end event
             log_file = get_log_file_path(session_id, cwd)
-            with open(log_file, "a", encoding="utf-8") as f:
-                f.write(json.dumps(log_entry) + "\n")
+            write_log_entry_atomic(log_file, log_entry)
 
     except Exception as e:
         print(f"[ERROR] Session {event_type}: {e}", file=sys.stderr)
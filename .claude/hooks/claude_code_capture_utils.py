@@ -3,21 +3,47 @@
 Utility functions for A/B testing hooks.
 Cross-platform support for Windows, macOS, and Linux.
 """
+import hashlib
 import json
 import os
+import time
 from pathlib import Path
 
+try:
+    import orjson  # Optional: faster serializer that produces bytes directly
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# Lane and experiment root by cwd; every hook asks for these several
+# times (once per tagged event) with the same cwd
+_lane_cache = {}
+_experiment_root_cache = {}
+
 def detect_model_lane(cwd):
     """Detect if we're in model_a or model_b directory."""
+    if cwd in _lane_cache:
+        return _lane_cache[cwd]
+
     path_parts = Path(cwd).parts
     if 'model_a' in path_parts:
-        return 'model_a'
+        model_lane = 'model_a'
     elif 'model_b' in path_parts:
-        return 'model_b'
-    return None
+        model_lane = 'model_b'
+    else:
+        model_lane = None
+
+    _lane_cache[cwd] = model_lane
+    return model_lane
 
 def get_experiment_root(cwd):
     """Get the experiment root directory (parent of model_a/model_b)."""
+    if cwd not in _experiment_root_cache:
+        _experiment_root_cache[cwd] = find_experiment_root(cwd)
+    return _experiment_root_cache[cwd]
+
+def find_experiment_root(cwd):
+    """Walk up from cwd looking for a directory containing model_a and model_b."""
     current_path = Path(cwd)
     
     # Check if we're inside a model_a or model_b directory
@@ -31,16 +57,26 @@ def get_experiment_root(cwd):
             return str(parent_up)
     return None
 
+# manifest.json contents by experiment root, so a hook that tags many
+# events opens the manifest once instead of once per event
+_manifest_cache = {}
+
 def read_manifest(experiment_root):
     """Read the manifest.json file to get task_id and model assignments."""
+    if experiment_root in _manifest_cache:
+        return _manifest_cache[experiment_root]
+
+    manifest = {}
     try:
         manifest_path = os.path.join(experiment_root, 'manifest.json')
         if os.path.exists(manifest_path):
             with open(manifest_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+                manifest = json.load(f)
     except Exception:
         pass
-    return {}
+
+    _manifest_cache[experiment_root] = manifest
+    return manifest
 
 def get_ab_metadata(cwd):
     """Get A/B testing metadata (task_id, model_lane, model_name) from current directory."""
@@ -65,6 +101,17 @@ def get_ab_metadata(cwd):
     
     return metadata
 
+def get_safe_session_id(session_id, transcript_path):
+    """Generate a safe session ID, with fallback for missing/unknown IDs."""
+    if not session_id or session_id == "unknown":
+        # Each hook of a session runs in its own process, so the fallback is
+        # derived from the transcript path to make them all agree on one file
+        if not transcript_path:
+            return "unknown"
+        digest = hashlib.sha256(transcript_path.encode("utf-8", "surrogatepass")).hexdigest()
+        return f"fallback_{digest[:8]}"
+    return session_id
+
 def get_log_file_path(session_id, cwd):
     """Get the correct log file path for A/B testing (routes to model-specific directory)."""
     model_lane = detect_model_lane(cwd)
@@ -82,6 +129,60 @@ def get_log_file_path(session_id, cwd):
         os.makedirs(logs_dir, exist_ok=True)
         return os.path.join(logs_dir, f"session_{session_id}.jsonl")
 
+# (seconds, "YYYY-MM-DDTHH:MM:SS") for the last second seen, so repeated
+# timestamps within one second skip strftime. Replaced as one tuple so a
+# concurrent caller never pairs a new second with a stale prefix.
+_utc_second_prefix = (None, "")
+
+def utc_now_iso():
+    """Current UTC time as an ISO 8601 string with microseconds and +00:00 offset."""
+    global _utc_second_prefix
+    seconds, micros = divmod(time.time_ns() // 1000, 1_000_000)
+    cached_seconds, prefix = _utc_second_prefix
+    if cached_seconds != seconds:
+        prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds))
+        _utc_second_prefix = (seconds, prefix)
+    return f"{prefix}.{micros:06d}+00:00"
+
+def write_log_entry_atomic(log_file, log_entry):
+    """Append a log entry as a single write to a file opened with O_APPEND."""
+    write_log_entries_atomic(log_file, [log_entry])
+
+def encode_log_line(log_entry):
+    """Serialize a log entry as one compact UTF-8 JSON line."""
+    if HAS_ORJSON:
+        try:
+            return orjson.dumps(log_entry) + b"\n"
+        except TypeError:
+            # orjson rejects some values stdlib json accepts (e.g. non-str
+            # keys, lone surrogates)
+            pass
+    try:
+        return json.dumps(log_entry, separators=(",", ":"), ensure_ascii=False).encode("utf-8") + b"\n"
+    except UnicodeEncodeError:
+        # Lone surrogates (from \udXXX escapes in transcripts) have no UTF-8
+        # encoding; ASCII-escaped JSON round-trips them losslessly
+        return json.dumps(log_entry, separators=(",", ":")).encode("ascii") + b"\n"
+
+def write_log_entries_atomic(log_file, log_entries):
+    """Append several log entries, serialized into one buffer and written with one write."""
+    data = b"".join(encode_log_line(entry) for entry in log_entries)
+
+    # On POSIX, O_APPEND moves to end-of-file and writes in one step, so
+    # concurrent appenders cannot interleave within a line and no lock is
+    # needed. Windows emulates O_APPEND with a seek then a write, so the
+    # concurrent write risk remains there. O_BINARY keeps Windows from
+    # translating newlines.
+    flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0)
+    fd = os.open(log_file, flags, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
 def add_ab_metadata(event, cwd):
     """Add A/B testing metadata to an event."""
     ab_metadata = get_ab_metadata(cwd)
@@ -7,12 +7,28 @@ Cross-platform support for Windows, macOS, and Linux.
 import json
 import sys
 import os
+import re
 import shutil
 import subprocess
-from datetime import datetime, timezone
+from datetime import datetime
 from pathlib import Path
 from collections import defaultdict
-from claude_code_capture_utils import get_log_file_path, add_ab_metadata, detect_model_lane, get_experiment_root
+from concurrent.futures import ThreadPoolExecutor
+from claude_code_capture_utils import (
+    get_log_file_path, add_ab_metadata, detect_model_lane, get_experiment_root,
+    utc_now_iso, encode_log_line, write_log_entries_atomic, get_safe_session_id
+)
+
+# Untracked paths containing any of these are left out of the git metrics
+UNTRACKED_EXCLUDE_PATTERNS = ['.claude/', '__pycache__/', 'node_modules/', '.mypy_cache/',
+                              '.pytest_cache/', '.DS_Store', '.vscode/', '.idea/']
+UNTRACKED_EXCLUDE_RE = re.compile('|'.join(re.escape(p) for p in UNTRACKED_EXCLUDE_PATTERNS))
+
+# Passed to git as exclude patterns so it never descends into these
+# directories while listing untracked files
+UNTRACKED_EXCLUDE_DIRS = ['.claude', '__pycache__', 'node_modules', '.mypy_cache',
+                          '.pytest_cache', '.vscode', '.idea']
+UNTRACKED_EXCLUDE_ARGS = [f'--exclude={d}/' for d in UNTRACKED_EXCLUDE_DIRS]
 
 def read_and_process_raw_transcript(transcript_path):
     """
@@ -270,41 +286,41 @@ def analyze_thinking_usage(messages, transcript_path):
 def calculate_git_metrics(cwd, base_commit):
     """Calculate git metrics from diff."""
     try:
-        original_cwd = os.getcwd()
-        os.chdir(cwd)
-        
         if not base_commit:
-            os.chdir(original_cwd)
             return {}
         
-        # Add untracked files
-        excluded_patterns = ['.claude/', '__pycache__/', 'node_modules/', '.mypy_cache/', 
-                           '.pytest_cache/', '.DS_Store', '.vscode/', '.idea/']
-        
+        # Add untracked files. -z output is raw path bytes, so decode as
+        # UTF-8 with surrogateescape: any filename survives the round trip
+        # back to git instead of failing on the locale encoding
         untracked_result = subprocess.run(
-            ['git', 'ls-files', '--others', '--exclude-standard'],
-            capture_output=True, text=True, timeout=30
+            ['git', '--no-optional-locks', 'ls-files', '--others', '--exclude-standard', '-z', *UNTRACKED_EXCLUDE_ARGS],
+            cwd=cwd, capture_output=True, encoding='utf-8', errors='surrogateescape', timeout=30
         )
         
-        if untracked_result.returncode == 0 and untracked_result.stdout.strip():
+        if untracked_result.returncode == 0 and untracked_result.stdout:
             untracked_files = [
-                f.strip() for f in untracked_result.stdout.strip().split('\n')
-                if f.strip() and not any(pattern in f for pattern in excluded_patterns)
+                f for f in untracked_result.stdout.split('\0')
+                if f and not UNTRACKED_EXCLUDE_RE.search(f)
             ]
             
-            for file in untracked_files:
-                subprocess.run(['git', 'add', '-N', file], capture_output=True, timeout=5)
+            # Mark all untracked files intent-to-add in one git invocation,
+            # feeding the paths NUL-separated on stdin
+            if untracked_files:
+                subprocess.run(
+                    ['git', '--literal-pathspecs', 'add', '-N',
+                     '--pathspec-from-file=-', '--pathspec-file-nul'],
+                    input='\0'.join(untracked_files),
+                    cwd=cwd, capture_output=True, encoding='utf-8', errors='surrogateescape', timeout=30
+                )
         
         # Calculate numstat
         result = subprocess.run(
-            ['git', 'diff', '--numstat', base_commit, '--', '.', 
+            ['git', '--no-optional-locks', 'diff', '--numstat', '--end-of-options', base_commit, '--', '.', 
              ':!.claude', ':!**/.mypy_cache', ':!**/__pycache__', ':!**/.pytest_cache',
              ':!**/.DS_Store', ':!**/node_modules', ':!**/.vscode', ':!**/.idea'],
-            capture_output=True, text=True, timeout=30
+            cwd=cwd, capture_output=True, text=True, timeout=30
         )
         
-        os.chdir(original_cwd)
-        
         if result.returncode != 0:
             return {}
         
@@ -331,8 +347,6 @@ def calculate_git_metrics(cwd, base_commit):
         
     except Exception as e:
         print(f"Warning: Could not calculate git metrics: {e}", file=sys.stderr)
-        if 'original_cwd' in locals():
-            os.chdir(original_cwd)
         return {}
 
 def copy_raw_transcript(transcript_path, session_id, cwd):
@@ -364,27 +378,6 @@ def copy_raw_transcript(transcript_path, session_id, cwd):
         print(f"[ERROR] Copying raw transcript: {e}", file=sys.stderr)
         return False
 
-def get_base_commit_from_log(log_file):
-    """Extract base commit from session_start event."""
-    try:
-        if not os.path.exists(log_file):
-            return None
-        
-        with open(log_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    try:
-                        event = json.loads(line)
-                        if event.get('type') == 'session_start':
-                            git_metadata = event.get('git_metadata', {})
-                            return git_metadata.get('base_commit')
-                    except json.JSONDecodeError:
-                        continue
-        return None
-    except Exception:
-        return None
-
 def main():
     try:
         if len(sys.argv) < 2:
@@ -398,8 +391,8 @@ def main():
         
         input_data = json.load(sys.stdin)
         
-        session_id = input_data.get("session_id", "unknown")
         transcript_path = input_data.get("transcript_path", "")
+        session_id = get_safe_session_id(input_data.get("session_id"), transcript_path)
         cwd = input_data.get("cwd", "")
         
         log_file = get_log_file_path(session_id, cwd)
@@ -438,34 +431,35 @@ def main():
                         except:
                             continue
             
-            # Append new messages
-            new_count = 0
-            with open(log_file, "a", encoding="utf-8") as f:
-                for msg_data in messages:
-                    # Check if this is a new message
-                    is_new = False
-                    if msg_data['type'] == 'assistant':
-                        msg_id = msg_data['message'].get('id')
-                        if msg_id and msg_id not in existing_assistant_ids:
-                            is_new = True
-                            existing_assistant_ids.add(msg_id)
-                    elif msg_data['type'] == 'assistant_thinking':
-                        msg_id = msg_data.get('message_id')
-                        if msg_id and msg_id not in existing_thinking_ids:
-                            is_new = True
-                            existing_thinking_ids.add(msg_id)
-                    elif msg_data['type'] == 'user':
-                        uuid = msg_data.get('uuid')
-                        if uuid and uuid not in existing_user_uuids:
-                            is_new = True
-                            existing_user_uuids.add(uuid)
-                    
-                    if is_new:
-                        # Add A/B metadata
-                        log_entry = add_ab_metadata(msg_data.copy(), cwd)
-                        f.write(json.dumps(log_entry) + "\n")
-                        new_count += 1
-            
+            # Collect new messages, then append them with a single write
+            new_entries = []
+            for msg_data in messages:
+                # Check if this is a new message
+                is_new = False
+                if msg_data['type'] == 'assistant':
+                    msg_id = msg_data['message'].get('id')
+                    if msg_id and msg_id not in existing_assistant_ids:
+                        is_new = True
+                        existing_assistant_ids.add(msg_id)
+                elif msg_data['type'] == 'assistant_thinking':
+                    msg_id = msg_data.get('message_id')
+                    if msg_id and msg_id not in existing_thinking_ids:
+                        is_new = True
+                        existing_thinking_ids.add(msg_id)
+                elif msg_data['type'] == 'user':
+                    uuid = msg_data.get('uuid')
+                    if uuid and uuid not in existing_user_uuids:
+                        is_new = True
+                        existing_user_uuids.add(uuid)
+                
+                if is_new:
+                    # Add A/B metadata
+                    new_entries.append(add_ab_metadata(msg_data.copy(), cwd))
+
+            if new_entries:
+                write_log_entries_atomic(log_file, new_entries)
+
+            new_count = len(new_entries)
             if new_count > 0:
                 print(f"[OK] Processed {new_count} new messages (total: {len(messages)} unique)")
                 
@@ -516,6 +510,20 @@ def main():
             
             print(f"[OK] Rebuilding log with {len(all_events)} events in chronological order")
             
+            # Start git metrics in the background (base commit comes from the
+            # session_start event already read above, so the log is not scanned
+            # a second time). git runs as a subprocess, so it overlaps with the
+            # summary analysis below.
+            base_commit = None
+            if session_start:
+                base_commit = (session_start[0].get('git_metadata') or {}).get('base_commit')
+            
+            git_metrics_future = None
+            if base_commit:
+                git_executor = ThreadPoolExecutor(max_workers=1)
+                git_metrics_future = git_executor.submit(calculate_git_metrics, cwd, base_commit)
+                git_executor.shutdown(wait=False)
+            
             # Step 4: Generate session summary
             usage_totals = aggregate_token_usage(messages)
             tool_metrics = analyze_tool_calls(messages)
@@ -576,16 +584,15 @@ def main():
             # Calculate actual total messages (excluding thinking blocks as they're not separate messages)
             actual_total_messages = assistant_count + total_user_events
             
-            # Get git metrics
-            base_commit = get_base_commit_from_log(log_file)
-            git_metrics = calculate_git_metrics(cwd, base_commit) if base_commit else {}
+            # Collect git metrics started before Step 4
+            git_metrics = git_metrics_future.result() if git_metrics_future else {}
             
             # Create session summary
             model_lane = detect_model_lane(cwd)
             
             summary = {
                 "type": "session_summary",
-                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "timestamp": utc_now_iso(),
                 "session_id": session_id,
                 "transcript_path": transcript_path,
                 "cwd": cwd,
@@ -628,13 +635,19 @@ def main():
             # Step 5: Rewrite log file with all events in perfect chronological order
             # Write to temp file first, then rename (atomic)
             temp_log_file = log_file + ".tmp"
-            
-            with open(temp_log_file, "w", encoding="utf-8") as f:
-                for event in all_events:
-                    f.write(json.dumps(event) + "\n")
-            
-            # Atomic rename
-            os.replace(temp_log_file, log_file)
+            data = b"".join(encode_log_line(event) for event in all_events)
+
+            try:
+                with open(temp_log_file, "wb") as f:
+                    f.write(data)
+
+                # Atomic rename
+                os.replace(temp_log_file, log_file)
+            except BaseException:
+                # Don't leave a partial temp file behind in logs/
+                if os.path.exists(temp_log_file):
+                    os.unlink(temp_log_file)
+                raise
             
             print(f"[OK] Rebuilt log with {len(all_events)} events in chronological order")
             print(f"[OK] Generated session summary: {actual_total_messages} messages, {assistant_count} assistant, {user_prompts} user prompts")
@@ -647,74 +660,6 @@ def main():
         print(f"[ERROR] Processing transcript: {e}", file=sys.stderr)
         sys.exit(1)
 
-def calculate_git_metrics(cwd, base_commit):
-    """Calculate git metrics from diff."""
-    try:
-        original_cwd = os.getcwd()
-        os.chdir(cwd)
-        
-        if not base_commit:
-            os.chdir(original_cwd)
-            return {}
-        
-        # Add untracked files
-        excluded_patterns = ['.claude/', '__pycache__/', 'node_modules/', '.mypy_cache/', 
-                           '.pytest_cache/', '.DS_Store', '.vscode/', '.idea/']
-        
-        untracked_result = subprocess.run(
-            ['git', 'ls-files', '--others', '--exclude-standard'],
-            capture_output=True, text=True, timeout=30
-        )
-        
-        if untracked_result.returncode == 0 and untracked_result.stdout.strip():
-            untracked_files = [
-                f.strip() for f in untracked_result.stdout.strip().split('\n')
-                if f.strip() and not any(pattern in f for pattern in excluded_patterns)
-            ]
-            
-            for file in untracked_files:
-                subprocess.run(['git', 'add', '-N', file], capture_output=True, timeout=5)
-        
-        # Calculate numstat
-        result = subprocess.run(
-            ['git', 'diff', '--numstat', base_commit, '--', '.', 
-             ':!.claude', ':!**/.mypy_cache', ':!**/__pycache__', ':!**/.pytest_cache',
-             ':!**/.DS_Store', ':!**/node_modules', ':!**/.vscode', ':!**/.idea'],
-            capture_output=True, text=True, timeout=30
-        )
-        
-        os.chdir(original_cwd)
-        
-        if result.returncode != 0:
-            return {}
-        
-        lines = result.stdout.strip().split('\n') if result.stdout.strip() else []
-        files_changed = 0
-        total_lines_changed = 0
-        
-        for line in lines:
-            if line.strip():
-                parts = line.split('\t')
-                if len(parts) >= 3:
-                    try:
-                        added = int(parts[0]) if parts[0] != '-' else 0
-                        removed = int(parts[1]) if parts[1] != '-' else 0
-                        files_changed += 1
-                        total_lines_changed += added + removed
-                    except ValueError:
-                        continue
-        
-        return {
-            "files_changed_count": files_changed,
-            "lines_of_code_changed_count": total_lines_changed
-        }
-        
-    except Exception as e:
-        print(f"Warning: Could not calculate git metrics: {e}", file=sys.stderr)
-        if 'original_cwd' in locals():
-            os.chdir(original_cwd)
-        return {}
-
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the session capture hooks.
+Run from this directory with: python -m pytest -q (or python -m unittest)
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from claude_code_capture_utils import encode_log_line, write_log_entries_atomic, get_safe_session_id
+from process_transcript import calculate_git_metrics
+import capture_session_event
+
+HOOKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestLogLineEncoding(unittest.TestCase):
+
+    def test_lone_surrogate_round_trips(self):
+        # json.loads turns a "\ud800" escape (as written by JSON.stringify)
+        # into a lone surrogate, which has no UTF-8 encoding
+        entry = json.loads('{"type": "user", "text": "bad \\ud800 char", "ok": "h\\u00e9llo"}')
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            log_file = os.path.join(temp_dir, "session_test.jsonl")
+            write_log_entries_atomic(log_file, [entry, {"type": "assistant", "text": "héllo"}])
+
+            with open(log_file, "rb") as f:
+                lines = f.read().splitlines()
+
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0]), entry)
+        self.assertEqual(json.loads(lines[1]), {"type": "assistant", "text": "héllo"})
+
+    def test_non_ascii_written_as_utf8(self):
+        line = encode_log_line({"text": "héllo"})
+        self.assertEqual(line, '{"text":"héllo"}\n'.encode("utf-8"))
+
+
+class TestFallbackSessionId(unittest.TestCase):
+
+    def run_hook(self, script, mode, input_data, project_dir):
+        env = dict(os.environ, CLAUDE_PROJECT_DIR=project_dir)
+        result = subprocess.run(
+            [sys.executable, os.path.join(HOOKS_DIR, script), mode],
+            input=json.dumps(input_data), capture_output=True, text=True,
+            cwd=project_dir, env=env, timeout=60
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_fallback_is_deterministic(self):
+        self.assertEqual(get_safe_session_id(None, "/t/a.jsonl"), get_safe_session_id("", "/t/a.jsonl"))
+        self.assertEqual(get_safe_session_id("unknown", "/t/a.jsonl"), get_safe_session_id(None, "/t/a.jsonl"))
+        self.assertNotEqual(get_safe_session_id(None, "/t/a.jsonl"), get_safe_session_id(None, "/t/b.jsonl"))
+        self.assertTrue(get_safe_session_id(None, "/t/a.jsonl").startswith("fallback_"))
+        self.assertEqual(get_safe_session_id("abc123-session-xyz", "/t/a.jsonl"), "abc123-session-xyz")
+
+    def test_hooks_without_session_id_share_one_log(self):
+        with tempfile.TemporaryDirectory() as project_dir:
+            transcript_path = os.path.join(project_dir, "transcript.jsonl")
+            with open(transcript_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({
+                    "type": "user", "uuid": "u1", "timestamp": "2026-01-01T00:00:00Z",
+                    "message": {"role": "user", "content": "hi"}
+                }) + "\n")
+
+            # No session_id in any hook input
+            input_data = {"transcript_path": transcript_path, "cwd": project_dir}
+            self.run_hook("capture_session_event.py", "start", input_data, project_dir)
+            self.run_hook("process_transcript.py", "incremental", input_data, project_dir)
+            self.run_hook("capture_session_event.py", "end", input_data, project_dir)
+            self.run_hook("process_transcript.py", "final", input_data, project_dir)
+
+            logs_dir = os.path.join(project_dir, "logs")
+            session_id = get_safe_session_id(None, transcript_path)
+            log_files = sorted(name for name in os.listdir(logs_dir) if not name.endswith("_raw.jsonl"))
+            self.assertEqual(log_files, [f"session_{session_id}.jsonl"])
+
+            with open(os.path.join(logs_dir, log_files[0]), encoding="utf-8") as f:
+                types = [json.loads(line)["type"] for line in f]
+            self.assertIn("session_start", types)
+            self.assertIn("session_summary", types)
+
+
+def git(repo_dir, *args):
+    subprocess.run(
+        ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', *args],
+        cwd=repo_dir, check=True, capture_output=True
+    )
+    result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True)
+    return result.stdout.strip()
+
+
+class TestGitMetrics(unittest.TestCase):
+
+    @unittest.skipIf(sys.platform in ("win32", "darwin"), "needs a filesystem that accepts non-UTF-8 names")
+    def test_non_utf8_untracked_filename(self):
+        with tempfile.TemporaryDirectory() as repo_dir:
+            git(repo_dir, 'init', '-q')
+            with open(os.path.join(repo_dir, 'base.txt'), 'w') as f:
+                f.write("base\n")
+            git(repo_dir, 'add', 'base.txt')
+            base_commit = git(repo_dir, 'commit', '-q', '-m', 'base')
+
+            with open(os.path.join(repo_dir, 'new.txt'), 'w') as f:
+                f.write("one\n")
+            with open(os.path.join(os.fsencode(repo_dir), b'bad\xff.txt'), 'w') as f:
+                f.write("two\nthree\n")
+
+            metrics = calculate_git_metrics(repo_dir, base_commit)
+
+        self.assertEqual(metrics.get('files_changed_count'), 2)
+        self.assertEqual(metrics.get('lines_of_code_changed_count'), 3)
+
+
+class TestGitMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_file = os.path.join(cache_dir.name, "git_meta_cache.json")
+        for name, value in (("GIT_METADATA_CACHE_DIR", cache_dir.name), ("GIT_METADATA_CACHE_FILE", self.cache_file)):
+            patcher = mock.patch.object(capture_session_event, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_repo(self, repo_dir):
+        git(repo_dir, 'init', '-q')
+        return git(repo_dir, 'commit', '-q', '--allow-empty', '-m', 'first')
+
+    def test_commit_invalidates_cache(self):
+        with tempfile.TemporaryDirectory() as repo_dir:
+            first = self.make_repo(repo_dir)
+            self.assertEqual(capture_session_event.get_git_metadata(repo_dir)["base_commit"], first)
+            self.assertTrue(os.path.exists(self.cache_file))
+
+            second = git(repo_dir, 'commit', '-q', '--allow-empty', '-m', 'second')
+            self.assertNotEqual(first, second)
+            self.assertEqual(capture_session_event.get_git_metadata(repo_dir)["base_commit"], second)
+
+    def test_branch_name_when_tag_shares_it(self):
+        with tempfile.TemporaryDirectory() as repo_dir:
+            self.make_repo(repo_dir)
+            git(repo_dir, 'checkout', '-q', '-b', 'main')
+            git(repo_dir, 'tag', 'main')
+            self.assertEqual(capture_session_event.query_git_metadata(repo_dir)["branch"], "main")
+
+            git(repo_dir, 'checkout', '-q', '--detach')
+            self.assertIsNone(capture_session_event.query_git_metadata(repo_dir)["branch"])
+
+    def test_unresolvable_ref_skips_cache(self):
+        with tempfile.TemporaryDirectory() as repo_dir:
+            self.make_repo(repo_dir)
+            # Lay out .git the way the reftable backend does: HEAD is a fixed
+            # stub whose ref exists neither loose nor in packed-refs
+            git_dir = os.path.join(repo_dir, '.git')
+            with open(os.path.join(git_dir, 'HEAD'), 'w') as f:
+                f.write("ref: refs/heads/.invalid\n")
+            self.assertFalse(os.path.exists(os.path.join(git_dir, 'packed-refs')))
+
+            self.assertIsNone(capture_session_event.get_git_head_key(repo_dir))
+            capture_session_event.get_git_metadata(repo_dir)
+            self.assertFalse(os.path.exists(self.cache_file))
+
+
+if __name__ == "__main__":
+    unittest.main()